@@ -7,7 +7,7 @@
  - تتبع مصادر منفصلة (lots) لكل معدن (كل مصدر/دفعة يحتفظ بكمية وسعر شراء)
  - بيع/سحب كمية مع احتساب cost-basis (FIFO) وحساب الربح لكل معدن وإجمالي الربح
  - سجل بالعربية، تصدير CSV/JSON، استيراد JSON
- - نسخ احتياطي تلقائي بأسماء ملفات بصيغة AM/PM
+ - نسخ احتياطي تلقائي مع عرض وقت النسخة بصيغة AM/PM
  - نافذة السجل تُفتح مكبَّرة
  - تعديل أسعار (سعر شراء افتراضي لكل معدن، سعر بيع افتراضي)
  - عند إغلاق البرنامج، يسأل المستخدم ما إذا كان يريد إنشاء نسخة احتياطية قبل الإغلاق
@@ -34,18 +34,62 @@
  - اختيار الدفعة عند البيع لاحتساب الربح بدقة
 """
 import os
+import math
+import re
+import unicodedata
 import json
 import csv
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from datetime import datetime
 import threading
+import queue
+import shutil
+import gzip
 from collections import defaultdict
+from operator import itemgetter
+from types import MappingProxyType
+try:
+    import orjson  # اختياري: ترميز JSON أسرع بكثير من المكتبة القياسية
+except ImportError:
+    orjson = None
+try:
+    import ujson  # اختياري: بديل أسرع من المكتبة القياسية إذا لم يتوفر orjson
+except ImportError:
+    ujson = None
 # إعدادات الملفات
 DATA_FILE = "data.json"
+WAL_FILE = "data.wal.jsonl"  # سجل التعديلات منذ آخر حفظ كامل لملف البيانات
+WAL_PENDING_FILE = "data.wal.pending.jsonl"  # تعديلات دخلت في لقطة لم تُكتب بعد إلى data.json
 BACKUP_DIR = "backups"
 AUTO_BACKUP_INTERVAL_SECONDS = 30 * 60  # 30 دقيقة
+BACKUP_DEBOUNCE_SECONDS = 5 * 60  # نسخة احتياطية بعد 5 دقائق من آخر تعديل
+BACKUP_RETENTION = 50  # عدد النسخ الاحتياطية المحتفظ بها (تُحذف الأقدم)
+BACKUP_TS_FORMAT = "%Y%m%dT%H%M%S"  # صيغة 24 ساعة يتطابق ترتيبها النصي مع ترتيبها الزمني
 SETTINGS_FILE = "settings.json"
+SCHEMA_VERSION = 2  # الملفات المكتوبة بهذا الإصدار لا تحتاج إلى تحديث بنيتها عند التحميل
+EXPORT_CHUNK_SIZE = 1024  # عدد الصفوف في كل دفعة عند التصدير
+JSON_PRETTY_MAX_ROWS = 1000  # السجلات الأقصر من هذا تُصدَّر JSON بتنسيق مقروء
+EXPORT_BUFFER_SIZE = 1 << 20  # حجم ذاكرة الكتابة المؤقتة لملفات التصدير (1 ميجابايت)
+IO_BUFFER_SIZE = 1 << 16  # حجم ذاكرة القراءة/النسخ المؤقتة لسجل التعديلات (64 كيلوبايت)
+HISTORY_FILL_CHUNK = 500  # عدد صفوف السجل المُدرجة في الجدول في كل دفعة
+HISTORY_FIRST_PAGE = 80  # الدفعة الأولى بحجم ما تعرضه نافذة مكبرة فقط لتظهر فورًا
+QTY_SCALE = 1_000_000  # الكميات تُحسب داخلياً بوحدات المليجرام (6 منازل عشرية للكيلوجرام)
+MONEY_SCALE = 100  # المبالغ تُحسب داخلياً بالقروش
+TREE_DETACH_MIN_ROWS = 200  # يُخفى جدول المعادن أثناء التحديث إذا تغير هذا العدد من الصفوف أو أكثر
+# أعمدة السجل بالترتيب المعروض في الجدول وملف CSV
+HISTORY_COLS = ("date","operation","metal","quantity","price_per_kg","total_price","person","paid_amount","due_amount","cost_basis","profit","profit_percentage")
+# عناوين أعمدة السجل بالعربية (بنفس ترتيب HISTORY_COLS) للجدول ولرأس ملف CSV
+HISTORY_HEADINGS_AR = ("التاريخ","العملية","المعدن","الكمية","السعر لكل كجم","القيمة الإجمالية","الطرف","المبلغ المدفوع","المبلغ المتبقي","تكلفة الشراء","الربح","نسبة الربح (%)")
+# سطر CSV لصف من السجل بدون علامات تنصيص (يُستخدم فقط عندما لا تحتاجها أي خلية)
+HISTORY_CSV_LINE = ",".join(["{}"] * len(HISTORY_COLS)) + "\r\n"
+# عنوان كل حقل من حقول السجل (للقراءة فقط)
+HISTORY_HEADERS_AR = MappingProxyType(dict(zip(HISTORY_COLS, HISTORY_HEADINGS_AR)))
+# حقول السجل الرقمية (تُحوَّل إلى float عند التعديل)
+HISTORY_NUMERIC_FIELDS = frozenset(("quantity", "price_per_kg", "total_price", "paid_amount", "due_amount", "cost_basis", "profit", "profit_percentage"))
+# أعمدة جدول معاملات العميل/المورد
+EXPENSE_COLS = ("date","name","amount","description")
+PARTY_TX_COLS = ("date","operation","metal","quantity","total_price","paid_amount","due_amount","profit")
 os.makedirs(BACKUP_DIR, exist_ok=True)
 # ---------------------------------------------------------------------
 # الدوال العامة
@@ -53,78 +97,279 @@ os.makedirs(BACKUP_DIR, exist_ok=True)
 def now_iso():
     """تاريخ ووقت بصيغة ISO مع AM/PM"""
     return datetime.now().strftime("%Y-%m-%dT%I:%M:%S %p")
+# رقم عشري اختياري الإشارة، ويُقبل الفاصل العشري "." أو ","
+NUMBER_RE = re.compile(r"^\s*-?(?:\d+(?:[.,]\d*)?|[.,]\d+)\s*$")
+# فاصلة تليها ثلاثة أرقام بالضبط تبدو فاصل آلاف ("1,000") فتُرفض بدلاً من قراءتها كسراً عشرياً
+THOUSANDS_RE = re.compile(r",\d{3}\s*$")
+def parse_number(text):
+    """تحويل نص مُدخل إلى رقم، أو None إذا لم يكن رقماً صالحاً"""
+    if not NUMBER_RE.match(text) or THOUSANDS_RE.search(text):
+        return None
+    return float(text.replace(",", "."))
+def json_dumps(obj, pretty=False):
+    """ترميز JSON إلى bytes بصيغة UTF-8 دون هروب للنص العربي (orjson ثم ujson إن توفرا)"""
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS
+        if pretty:
+            opt |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=opt)
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False, indent=2 if pretty else 0).encode("utf-8")
+    if pretty:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+def json_loads(raw):
+    """فك ترميز JSON من bytes (orjson ثم ujson إن توفرا)"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    if ujson is not None:
+        return ujson.loads(raw)
+    return json.loads(raw)
+def read_json_file(path):
+    """قراءة ملف JSON دفعة واحدة (مع فك الضغط إذا كان .gz)"""
+    with (gzip.open(path, "rb") if path.endswith(".gz") else open(path, "rb")) as f:
+        return json_loads(f.read())
 def backup_timestamp():
     """تاريخ ووقت لاسم النسخة الاحتياطية"""
-    return datetime.now().strftime("%Y-%m-%d_%I-%M-%p")
+    return datetime.now().strftime(BACKUP_TS_FORMAT)
+def backup_label(name):
+    """عرض وقت النسخة الاحتياطية بصيغة AM/PM (الأسماء القديمة تُعرض كما هي)"""
+    try:
+        ts = datetime.strptime(name[len("backup_"):].split(".", 1)[0], BACKUP_TS_FORMAT)
+    except ValueError:
+        return name
+    return ts.strftime("%Y-%m-%d %I:%M:%S %p")
+def normalize_data(d):
+    """إكمال البيانات المقروءة وتحديث بنيتها إذا كانت قديمة"""
+    if "metals" not in d:
+        d["metals"] = []
+    if "history" not in d:
+        d["history"] = []
+    if "parties" not in d:
+        d["parties"] = {}  # لحفظ معلومات العملاء والموردين
+    if "expenses" not in d:
+        d["expenses"] = []  # لحفظ المصروفات
+    if d.get("schema") == SCHEMA_VERSION:
+        return d  # كُتب بالبنية الحالية (معادن بدفعات)
+    # تحديث البنية إذا كانت قديمة
+    for m in d.get("metals", []):
+        if "lots" not in m:
+            lots = []
+            if m.get("quantity", 0) and (m.get("price_per_kg", None) is not None):
+                src = m.get("source", "مصدر افتراضي")
+                qty = float(m.get("quantity", 0))
+                total_paid = round(qty * float(m.get("price_per_kg", 0)), 2)
+                lots.append({
+                    "source": src,
+                    "quantity": qty,
+                    "total_paid": total_paid,
+                    "date": m.get("last_updated", now_iso()),
+                    "price_per_kg": float(m.get("price_per_kg", 0))
+                })
+            m["lots"] = lots
+        if "price_per_kg" not in m:
+            m["price_per_kg"] = 0.0
+        if "sale_price_per_kg" not in m:
+            m["sale_price_per_kg"] = m.get("price_per_kg", 0.0)
+        if "profit_total" not in m:
+            m["profit_total"] = 0.0
+    d["schema"] = SCHEMA_VERSION
+    return d
 def load_data():
-    """تحميل البيانات من data.json"""
-    if os.path.exists(DATA_FILE):
+    """تحميل البيانات من data.json ثم إعادة تطبيق سجل التعديلات (WAL)"""
+    global _wal_gen
+    if os.path.exists(DATA_FILE) or os.path.exists(WAL_PENDING_FILE) or os.path.exists(WAL_FILE):
         try:
-            with open(DATA_FILE, "r", encoding="utf-8") as f:
-                d = json.load(f)
-            if "metals" not in d:
-                d["metals"] = []
-            if "history" not in d:
-                d["history"] = []
-            if "parties" not in d:
-                d["parties"] = {}  # لحفظ معلومات العملاء والموردين
-            if "expenses" not in d:
-                d["expenses"] = []  # لحفظ المصروفات
-            # تحديث البنية إذا كانت قديمة
-            for m in d.get("metals", []):
-                if "lots" not in m:
-                    lots = []
-                    if m.get("quantity", 0) and (m.get("price_per_kg", None) is not None):
-                        src = m.get("source", "مصدر افتراضي")
-                        qty = float(m.get("quantity", 0))
-                        total_paid = round(qty * float(m.get("price_per_kg", 0)), 2)
-                        lots.append({
-                            "source": src,
-                            "quantity": qty,
-                            "total_paid": total_paid,
-                            "date": m.get("last_updated", now_iso()),
-                            "price_per_kg": float(m.get("price_per_kg", 0))
-                        })
-                    m["lots"] = lots
-                if "price_per_kg" not in m:
-                    m["price_per_kg"] = 0.0
-                if "sale_price_per_kg" not in m:
-                    m["sale_price_per_kg"] = m.get("price_per_kg", 0.0)
-                if "profit_total" not in m:
-                    m["profit_total"] = 0.0
+            d = read_json_file(DATA_FILE) if os.path.exists(DATA_FILE) else {}
+            _wal_gen = d.get("wal_gen", 0)
+            replay_wal(d)
+            legacy = d.get("schema") != SCHEMA_VERSION
+            normalize_data(d)
+            if legacy:
+                # حفظ البنية المحدثة مرة واحدة حتى لا يتكرر التحديث في كل تشغيل
+                compact_data(d)
             return d
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل قراءة ملف البيانات: {e}")
-            return {"metals": [], "history": [], "parties": {}, "expenses": []}
+            return {"metals": [], "history": [], "parties": {}, "expenses": [], "schema": SCHEMA_VERSION}
     else:
-        return {"metals": [], "history": [], "parties": {}, "expenses": []}
-def save_data(data):
-    """حفظ البيانات إلى data.json"""
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        return {"metals": [], "history": [], "parties": {}, "expenses": [], "schema": SCHEMA_VERSION}
+def atomic_write(path, payload, fsync=True):
+    """كتابة الملف في ملف مؤقت ثم استبداله دفعة واحدة حتى لا يبقى ملف مقطوع عند الانقطاع"""
+    tmp = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+def save_data(payload):
+    """كتابة لقطة البيانات المرمزة (bytes) إلى data.json"""
+    atomic_write(DATA_FILE, payload)
+# ---------------------------------------------------------------------
+# سجل التعديلات (WAL): كل تعديل يُلحق كسطر JSON بدلاً من إعادة كتابة الملف كاملاً
+# ---------------------------------------------------------------------
+_wal_file = None
+_wal_gen = 0  # جيل البيانات الحالي؛ يزداد عند استبدالها كاملة (استيراد أو استعادة)
+_wal_lock = threading.Lock()
+_save_q = queue.Queue(maxsize=1)  # أحدث لقطة فقط بانتظار الكتابة
+_writer_thread = None
+def append_events(events):
+    """إلحاق أحداث التعديل بسجل WAL في كتابة واحدة"""
+    global _wal_file
+    payload = b"".join(json_dumps(ev) + b"\n" for ev in events)
+    with _wal_lock:
+        if _wal_file is None:
+            _wal_file = open(WAL_FILE, "ab")
+            # كل فتح للسجل يبدأ بجيل البيانات التي تنطبق عليها التعديلات التالية
+            payload = json_dumps({"op": "gen", "gen": _wal_gen}) + b"\n" + payload
+        _wal_file.write(payload)
+        _wal_file.flush()
+def apply_event(d, ev):
+    """تطبيق حدث واحد على البيانات (إعادة تطبيقه لا تغير النتيجة)"""
+    op = ev.get("op")
+    if op == "metal":
+        metal = ev["data"]
+        metals = d.setdefault("metals", [])
+        for i, m in enumerate(metals):
+            if m.get("name") == metal.get("name"):
+                metals[i] = metal
+                break
+        else:
+            metals.append(metal)
+    elif op == "metal_del":
+        d["metals"] = [m for m in d.get("metals", []) if m.get("name") != ev["name"]]
+    elif op == "history":
+        history = d.setdefault("history", [])
+        index = ev["index"]
+        if index < len(history):
+            history[index] = ev["data"]
+        elif index == len(history):
+            history.append(ev["data"])
+    elif op == "party":
+        d.setdefault("parties", {})[ev["name"]] = ev["data"]
+    elif op == "expenses":
+        d["expenses"] = ev["data"]
+def replay_wal(d):
+    """إعادة تطبيق التعديلات المسجلة منذ آخر حفظ كامل"""
+    gen = d.get("wal_gen", 0)
+    for path in (WAL_PENDING_FILE, WAL_FILE):
+        if not os.path.exists(path):
+            continue
+        active = True
+        good = 0  # نهاية آخر سطر سليم
+        torn = False
+        with open(path, "rb", buffering=IO_BUFFER_SIZE) as f:
+            for line in f:
+                # كل حدث يُكتب مع سطره الجديد، فالسطر بدونه مقطوع حتى لو أمكن تحليله
+                if not line.endswith(b"\n"):
+                    torn = True
+                    break
+                try:
+                    ev = json_loads(line)
+                except ValueError:
+                    torn = True
+                    break  # سطر أخير ناقص بسبب إغلاق مفاجئ
+                good += len(line)
+                if ev.get("op") == "gen":
+                    # تعديلات جيل سابق كانت على بيانات استُبدلت كاملة، فلا تُطبق على الحالية
+                    active = ev["gen"] == gen
+                elif active:
+                    apply_event(d, ev)
+        if torn:
+            # حذف الجزء المقطوع حتى لا تُلحق به التعديلات التالية فتضيع عند التحميل القادم
+            with open(path, "r+b") as f:
+                f.truncate(good)
+def data_writer_loop():
+    """كتابة لقطات البيانات إلى data.json في الخلفية ثم حذف سجل التعديلات المدمج فيها"""
+    while True:
+        payload = _save_q.get()
+        try:
+            save_data(payload)
+            with _wal_lock:
+                # لقطة أحدث بالانتظار قد تعتمد على نفس السجل، فنتركه لها
+                if _save_q.empty() and os.path.exists(WAL_PENDING_FILE):
+                    os.remove(WAL_PENDING_FILE)
+        except Exception as e:
+            print("Save failed:", e)
+        finally:
+            _save_q.task_done()
+def compact_data(data, replace=False):
+    """دمج سجل WAL في data.json: الترميز هنا والكتابة في خيط الحفظ (تُعاد اللقطة المرمزة)"""
+    global _wal_file, _writer_thread, _wal_gen
+    if replace:
+        # بيانات جديدة بالكامل: جيل جديد حتى لا يُعاد تطبيق السجل القديم عليها بعد انقطاع مفاجئ
+        _wal_gen += 1
+        data["wal_gen"] = _wal_gen
+    # data.json يُقرأ آلياً فقط، فيُكتب بلا مسافات بادئة
+    payload = json_dumps(data)
+    with _wal_lock:
+        if _wal_file is not None:
+            _wal_file.close()
+            _wal_file = None
+        # نقل السجل الحالي إلى ملف الانتظار حتى تُكتب اللقطة التي تحتويه
+        if os.path.exists(WAL_FILE):
+            if os.path.exists(WAL_PENDING_FILE):
+                with open(WAL_FILE, "rb") as src, open(WAL_PENDING_FILE, "ab") as dst:
+                    shutil.copyfileobj(src, dst, IO_BUFFER_SIZE)
+                os.remove(WAL_FILE)
+            else:
+                os.replace(WAL_FILE, WAL_PENDING_FILE)
+        # الإبقاء على أحدث لقطة فقط
+        while True:
+            try:
+                _save_q.put_nowait(payload)
+                break
+            except queue.Full:
+                try:
+                    _save_q.get_nowait()
+                    _save_q.task_done()
+                except queue.Empty:
+                    pass
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=data_writer_loop, daemon=True)
+            _writer_thread.start()
+    return payload
+def flush_data_writes():
+    """انتظار انتهاء كتابة كل اللقطات المعلقة"""
+    _save_q.join()
 def make_backup(data):
     """إنشاء نسخة احتياطية جديدة"""
+    # النسخ الاحتياطية تُقرأ آلياً فقط، فتُكتب مضغوطة وبلا مسافات بادئة
+    return write_backup(json_dumps(data))
+def write_backup(payload):
+    """كتابة بيانات مرمَّزة مسبقاً كنسخة احتياطية (الضغط والكتابة لا يحجزان GIL)"""
     ts = backup_timestamp()
-    filename = os.path.join(BACKUP_DIR, f"backup_{ts}.json")
+    filename = os.path.join(BACKUP_DIR, f"backup_{ts}.json.gz")
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # النسخ الاحتياطية تتحمل الفقد عند انقطاع الكهرباء، فلا حاجة لانتظار fsync
+        atomic_write(filename, gzip.compress(payload, compresslevel=3), fsync=False)
+        prune_backups()
         return filename
     except Exception as e:
         print("Backup failed:", e)
         return None
-def start_auto_backup(app):
-    """بدء النسخ الاحتياطي التلقائي"""
-    def loop():
-        while True:
-            try:
-                data = app.data
-                make_backup(data)
-            except Exception as e:
-                print("Auto-backup error:", e)
-            threading.Event().wait(AUTO_BACKUP_INTERVAL_SECONDS)
-    t = threading.Thread(target=loop, daemon=True)
-    t.start()
+def prune_backups(keep=BACKUP_RETENTION):
+    """حذف أقدم النسخ الاحتياطية بحيث يبقى آخر keep نسخة فقط"""
+    # الأسماء بصيغة زمنية قابلة للترتيب، فلا حاجة لقراءة وقت تعديل كل ملف
+    with os.scandir(BACKUP_DIR) as it:
+        backups = [(e.name, e.path) for e in it if e.name.startswith("backup_")]
+    if len(backups) <= keep:
+        return
+    backups.sort()
+    for _, path in backups[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+def latest_backup():
+    """اسم أحدث نسخة احتياطية (أكبر اسم) بقراءة واحدة للمجلد دون ترتيب"""
+    latest = None
+    with os.scandir(BACKUP_DIR) as it:
+        for e in it:
+            if e.name.startswith("backup_") and (latest is None or e.name > latest):
+                latest = e.name
+    return latest
 def load_settings():
     """تحميل إعدادات التطبيق (الوضع المظلم/الفاتح)"""
     if os.path.exists(SETTINGS_FILE):
@@ -148,6 +393,7 @@ def combine_lots_with_same_price(metal):
         price_groups[price].append(lot)
     # إنشاء دفعات جديدة مدمجة
     new_lots = []
+    now = now_iso()  # تاريخ بديل للدفعات التي لا تاريخ لها
     for price, lots in price_groups.items():
         total_quantity = sum(lot.get("quantity", 0) for lot in lots)
         total_paid = sum(lot.get("total_paid", 0) for lot in lots)
@@ -158,87 +404,135 @@ def combine_lots_with_same_price(metal):
                 "source": first_lot.get("source", "مصدر افتراضي"),
                 "quantity": total_quantity,
                 "total_paid": total_paid,
-                "date": min(lot.get("date", now_iso()) for lot in lots),
+                "date": min(lot.get("date", now) for lot in lots),
                 "price_per_kg": price
             })
     metal["lots"] = new_lots
+    invalidate_metal_totals(metal)
 # ---------------------------------------------------------------------
 # دوال المساعدة
 # ---------------------------------------------------------------------
+# id(المعدن) -> (المعدن، الكمية، المدفوع)؛ نحتفظ بالمعدن نفسه للتحقق من الهوية
+_totals_cache = {}
+def invalidate_metal_totals(metal):
+    """إبطال إجماليات المعدن المخزنة بعد أي تعديل على دفعاته أو حذفه"""
+    _totals_cache.pop(id(metal), None)
+def clear_metal_totals():
+    """مسح كل الإجماليات المخزنة (عند استبدال البيانات)"""
+    _totals_cache.clear()
+    _search_cache.clear()
+def metal_totals(metal):
+    """إجمالي الكمية والمدفوع للمعدن، يُعاد حسابهما فقط بعد إبطالهما"""
+    cached = _totals_cache.get(id(metal))
+    if cached is None or cached[0] is not metal:
+        lots = metal.get("lots", [])
+        cached = _totals_cache[id(metal)] = (
+            metal,
+            round(sum(l.get("quantity", 0.0) for l in lots), 6),
+            round(sum(l.get("total_paid", 0.0) for l in lots), 2),
+        )
+    return cached[1], cached[2]
 def metal_total_quantity(metal):
     """احسب إجمالي الكمية المتاحة من جميع المصادر"""
-    return round(sum(l.get("quantity", 0.0) for l in metal.get("lots", [])), 6)
+    return metal_totals(metal)[0]
 def metal_total_paid(metal):
     """احسب إجمالي المبلغ المدفوع لكل المعدن"""
-    return round(sum(l.get("total_paid", 0.0) for l in metal.get("lots", [])), 2)
+    return metal_totals(metal)[1]
+# id(المعدن) -> (المعدن، الحقول المستخدمة، نص البحث)
+# توحيد أشكال الألف والتاء المربوطة والألف المقصورة وحذف التشكيل والتطويل
+SEARCH_TABLE = str.maketrans(
+    {"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ة": "ه", "ى": "ي", "\u0640": None, "\u0670": None,
+     **{chr(c): None for c in range(0x064B, 0x0653)}}
+)
+def normalize_search(text):
+    """تطبيع نص البحث: أشكال الحروف العربية المتكافئة وحالة الأحرف اللاتينية"""
+    return unicodedata.normalize("NFKC", text).casefold().translate(SEARCH_TABLE)
+_search_cache = {}
+def metal_search_text(metal):
+    """نص البحث للمعدن (الاسم وسعرا الشراء والبيع بعد التطبيع)، يُعاد بناؤه عند تغير الحقول فقط"""
+    key = (metal.get("name", ""), metal.get("price_per_kg", ""), metal.get("sale_price_per_kg", ""))
+    cached = _search_cache.get(id(metal))
+    if cached is None or cached[0] is not metal or cached[1] != key:
+        cached = _search_cache[id(metal)] = (metal, key, normalize_search("|".join(map(str, key))))
+    return cached[2]
+def to_qty_units(qty):
+    """تحويل كمية بالكيلوجرام إلى عدد صحيح من وحدات QTY_SCALE"""
+    return round(float(qty) * QTY_SCALE)
+def to_money_units(amount):
+    """تحويل مبلغ بالجنيه إلى عدد صحيح من القروش"""
+    return round(float(amount) * MONEY_SCALE)
+def line_cost_units(qty_units, price):
+    """تكلفة كمية (بوحدات QTY_SCALE) بسعر للكيلوجرام، مقربة إلى أقرب قرش (النصف لأعلى)"""
+    return math.floor(qty_units * float(price) * MONEY_SCALE / QTY_SCALE + 0.5)
 def deduct_from_specific_lot(metal, lot_index, qty_to_remove):
     """خصم كمية من دفعة محددة وارجاع التكلفة"""
     if lot_index >= len(metal["lots"]):
         raise ValueError("الدفعة المحددة غير موجودة")
     lot = metal["lots"][lot_index]
-    lot_qty = float(lot.get("quantity", 0.0))
-    lot_paid = float(lot.get("total_paid", 0.0))
+    # الحساب بأعداد صحيحة (مليجرام/قرش) لتجنب تراكم أخطاء الكسور العشرية
+    lot_u = to_qty_units(lot.get("quantity", 0.0))
+    remove_u = to_qty_units(qty_to_remove)
     lot_price = float(lot.get("price_per_kg", metal.get("price_per_kg", 0.0)))
-    if qty_to_remove > lot_qty + 1e-9:
-        raise ValueError(f"الكمية المطلوبة ({qty_to_remove}) أكبر من المتوفر في الدفعة ({lot_qty})")
+    if remove_u > lot_u:
+        raise ValueError(f"الكمية المطلوبة ({qty_to_remove}) أكبر من المتوفر في الدفعة ({lot.get('quantity', 0.0)})")
     # حساب التكلفة
-    cost = round(qty_to_remove * lot_price, 2)
+    cost_c = line_cost_units(remove_u, lot_price)
     # تحديث الدفعة
-    new_qty = lot_qty - qty_to_remove
-    new_total_paid = lot_paid - cost
-    if new_qty > 0:
-        metal["lots"][lot_index]["quantity"] = round(new_qty, 6)
-        metal["lots"][lot_index]["total_paid"] = round(new_total_paid, 2)
+    new_u = lot_u - remove_u
+    if new_u > 0:
+        lot["quantity"] = new_u / QTY_SCALE
+        lot["total_paid"] = (to_money_units(lot.get("total_paid", 0.0)) - cost_c) / MONEY_SCALE
     else:
         # حذف الدفعة إذا نفدت كميتها
         metal["lots"].pop(lot_index)
+    invalidate_metal_totals(metal)
     # إذا أصبحت جميع الكميات صفرًا، نقوم بتحديث السعر الرئيسي
     if metal_total_quantity(metal) == 0 and metal["lots"]:
         metal["price_per_kg"] = metal["lots"][0].get("price_per_kg", 0.0)
         metal["sale_price_per_kg"] = metal["price_per_kg"]
-    return cost
+    return cost_c / MONEY_SCALE
 def deduct_from_lots(metal, qty_to_remove):
     """خصم كمية من المخزون (FIFO) وارجاع التكلفة"""
-    remaining = qty_to_remove
-    cost = 0.0
-    new_lots = []
-    for lot in metal.get("lots", []):
-        if remaining <= 0:
-            new_lots.append(lot)
-            continue
-        lot_qty = float(lot.get("quantity", 0.0))
-        lot_paid = float(lot.get("total_paid", 0.0))
-        lot_price = float(lot.get("price_per_kg", metal.get("price_per_kg", 0.0)))
-        if lot_qty <= 0:
-            new_lots.append(lot)
+    # الحساب بأعداد صحيحة (مليجرام/قرش) لتجنب تراكم أخطاء الكسور العشرية
+    remaining_u = to_qty_units(qty_to_remove)
+    cost_c = 0
+    lots = metal.get("lots", [])
+    default_price = metal.get("price_per_kg", 0.0)
+    partial = None  # الدفعة التي يُخصم جزء منها وقيمها الجديدة
+    end = len(lots)  # أول دفعة لم تُستهلك بالكامل
+    for i, lot in enumerate(lots):
+        if remaining_u <= 0:
+            end = i
+            break
+        lot_u = to_qty_units(lot.get("quantity", 0.0))
+        if lot_u <= 0:
             continue
-        if lot_qty <= remaining + 1e-9:
-            cost += round(lot_qty * lot_price, 2)
-            remaining -= lot_qty
+        lot_price = float(lot.get("price_per_kg", default_price))
+        if lot_u <= remaining_u:
+            cost_c += line_cost_units(lot_u, lot_price)
+            remaining_u -= lot_u
         else:
-            portion = remaining / lot_qty
-            part_paid = lot_paid * portion
-            cost += round(remaining * lot_price, 2)
-            new_qty = lot_qty - remaining
-            new_total_paid = lot_paid - part_paid
-            new_lot = {
-                "source": lot["source"],
-                "quantity": round(new_qty, 6),
-                "total_paid": round(new_total_paid, 2),
-                "date": lot.get("date"),
-                "price_per_kg": lot_price
-            }
-            new_lots.append(new_lot)
-            remaining = 0
-    if remaining > 1e-9:
+            paid_c = to_money_units(lot.get("total_paid", 0.0))
+            cost_c += line_cost_units(remaining_u, lot_price)
+            # المدفوع المتبقي يتناسب مع الكمية المتبقية
+            part_c = paid_c * remaining_u // lot_u
+            partial = (lot, (lot_u - remaining_u) / QTY_SCALE, (paid_c - part_c) / MONEY_SCALE, lot_price)
+            end = i
+            remaining_u = 0
+            break
+    if remaining_u > 0:
         raise ValueError("الكمية المطلوبة للسحب أكبر من المتوفر.")
-    # حذف الدفعات التي نفدت كميتها
-    metal["lots"] = [lot for lot in new_lots if lot.get("quantity", 0) > 0]
+    # لا نعدل الدفعات إلا بعد التأكد من كفاية الكمية
+    if partial:
+        lot, lot["quantity"], lot["total_paid"], lot["price_per_kg"] = partial
+    # حذف الدفعات المستهلكة والتي نفدت كميتها
+    metal["lots"] = [lot for lot in lots[end:] if lot.get("quantity", 0) > 0]
+    invalidate_metal_totals(metal)
     # إذا أصبحت جميع الكميات صفرًا، نقوم بتحديث السعر الرئيسي
     if metal_total_quantity(metal) == 0 and metal["lots"]:
         metal["price_per_kg"] = metal["lots"][0].get("price_per_kg", 0.0)
         metal["sale_price_per_kg"] = metal["price_per_kg"]
-    return round(cost, 2)
+    return cost_c / MONEY_SCALE
 def deduct_from_lots_with_multiple_sources(metal, qty_to_remove):
     """خصم كمية من المخزون من مصادر متعددة إذا لزم الأمر"""
     remaining = qty_to_remove
@@ -267,6 +561,7 @@ def deduct_from_lots_with_multiple_sources(metal, qty_to_remove):
             lot["total_paid"] = new_total_paid
             sources_used.append((lot.get("source", ""), remaining, lot_price))
             remaining = 0
+    invalidate_metal_totals(metal)
     if remaining > 1e-9:
         raise ValueError("الكمية المطلوبة للسحب أكبر من المتوفر.")
     # إذا أصبحت جميع الكميات صفرًا، نقوم بتحديث السعر الرئيسي
@@ -274,6 +569,46 @@ def deduct_from_lots_with_multiple_sources(metal, qty_to_remove):
         metal["price_per_kg"] = metal["lots"][0].get("price_per_kg", 0.0)
         metal["sale_price_per_kg"] = metal["price_per_kg"]
     return round(cost, 2), sources_used
+# إجراء Tcl يدرج قائمة صفوف كاملة في جدول بمعرّفات متتالية (استدعاء واحد من Python)
+TCL_BULK_INSERT = """
+proc metalica_bulk_insert {w start rows} {
+    set i $start
+    foreach r $rows {
+        $w insert {} end -id $i -values $r
+        incr i
+    }
+}
+"""
+def tree_insert_rows(tree, rows, start=0):
+    """إدراج صفوف في الجدول بمعرّفات متتالية تبدأ من start عبر استدعاء Tcl واحد"""
+    call = tree.tk.call
+    if not call("info", "commands", "metalica_bulk_insert"):
+        tree.tk.eval(TCL_BULK_INSERT)
+    call("metalica_bulk_insert", tree._w, start, tuple(rows))
+def format_csv_rows(rows, line_format, columns):
+    """تنسيق صفوف CSV بعملية تنسيق واحدة لكل صف؛ يرجع None إذا احتاجت أي خلية علامات تنصيص"""
+    fmt = line_format.format
+    text = "".join([fmt(*r) for r in rows])
+    n = len(rows)
+    # فاصلة أو علامة تنصيص أو سطر جديد داخل خلية، أو قيمة None، تتطلب معالجة csv.writer
+    if (text.count(",") != (columns - 1) * n or text.count("\n") != n or text.count("\r") != n
+            or '"' in text or "None" in text):
+        return None
+    return text
+_history_getter = itemgetter(*HISTORY_COLS)
+def history_row(h):
+    """تحويل سجل عملية إلى صف قيم بترتيب أعمدة جدول السجل دون تعديل السجل نفسه"""
+    try:
+        return _history_getter(h)  # استدعاء واحد عندما تكون كل الأعمدة موجودة
+    except KeyError:
+        return tuple(h.get(k, "") for k in HISTORY_COLS)
+_expense_getter = itemgetter(*EXPENSE_COLS)
+def expense_row(e):
+    """تحويل مصروف إلى صف قيم بترتيب أعمدة جدول المصروفات دون تعديل المصروف نفسه"""
+    try:
+        return _expense_getter(e)
+    except KeyError:
+        return tuple(e.get(k, "") for k in EXPENSE_COLS)
 def update_party_balance(parties, party_name, amount, transaction_type, is_supplier=False, transaction_details=None):
     """تحديث رصيد العميل/المورد وإضافة تفصيل المعاملة"""
     if party_name not in parties:
@@ -291,7 +626,7 @@ def update_party_balance(parties, party_name, amount, transaction_type, is_suppl
         parties[party_name]["balance"] = round(parties[party_name]["balance"] - amount, 2)
     # إضافة تفصيل المعاملة إذا كان متوفرًا
     if transaction_details:
-        transaction_details["date"] = now_iso()
+        transaction_details.setdefault("date", now_iso())
         transaction_details["type"] = transaction_type
         parties[party_name]["transactions"].append(transaction_details)
 # ---------------------------------------------------------------------
@@ -302,6 +637,7 @@ class MetalInventoryApp(tk.Tk):
         super().__init__()
         self.title("Metalica - إدارة مخزون المعادن")
         self.geometry("1200x700")
+        # خط عناصر tk وحقول الإدخال (Entry/Combobox وقائمتها) يؤخذ من قاعدة الخيارات لا من أنماط ttk
         self.option_add("*Font", ("Cairo", 11))
         # تحميل الإعدادات
         self.settings = load_settings()
@@ -316,13 +652,114 @@ class MetalInventoryApp(tk.Tk):
         # لتتبع حالة عرض/إخفاء الدفعات
         self.expanded_metals = set()
         # --------------------------------------------------------------------
+        self._history_win = None  # نافذة السجل (تُخفى عند الإغلاق ويُعاد استخدامها)
+        self.data_version = 0  # يزداد مع كل تعديل محفوظ
+        self._backup_version = 0  # إصدار البيانات عند آخر نسخة احتياطية
+        self._backup_after_id = None
+        self._inventory_value = (-1, 0.0)  # (إصدار البيانات، قيمة المخزون)
+        self._compacted_version = 0  # إصدار البيانات عند آخر دمج لسجل WAL
+        self._row_cache = {}  # iid -> (الأب, القيم) كما عُرضت آخر مرة في الجدول
+        self._history_logged = len(self.data["history"])  # عدد السجلات المحفوظة حتى الآن
+        self._last_backup_name = latest_backup()  # يُحدَّث عند كتابة كل نسخة جديدة
+        self.reindex_metals()
         self.refresh_table()
-        start_auto_backup(self)
+        self._backup_thread = None  # خيط كتابة آخر نسخة احتياطية تلقائية
+        self._backup_results = queue.Queue()  # أسماء النسخ المكتوبة، يقرؤها الخيط الرئيسي
+        self._exit_after_id = None
+        self._exiting = False  # نافذة تأكيد الخروج معروضة
+        self._auto_backup_id = self.after(AUTO_BACKUP_INTERVAL_SECONDS * 1000, self.periodic_backup)
         self.protocol("WM_DELETE_WINDOW", self.on_exit)  # عند الإغلاق
         # self.expanded_metals = set() # Move this line up before refresh_table()
+    def persist(self, metals=(), parties=(), history=(), deleted_metals=(), expenses=False, full=False):
+        """تسجيل التعديلات في WAL وتأجيل النسخة الاحتياطية إلى الدورة التلقائية التالية"""
+        # السجلات المضافة منذ آخر حفظ تُسجل تلقائياً، و full تحفظ البيانات كاملة (عند استبدالها)
+        self.data_version += 1
+        # تأجيل النسخة الاحتياطية حتى تهدأ سلسلة التعديلات
+        if self._backup_after_id is not None:
+            self.after_cancel(self._backup_after_id)
+        self._backup_after_id = self.after(BACKUP_DEBOUNCE_SECONDS * 1000, self.maybe_backup)
+        data = self.data
+        start = self._history_logged
+        if full:
+            self.compact(replace=True)
+        else:
+            events = [{"op": "metal_del", "name": name} for name in deleted_metals]
+            for name in metals:
+                metal = self._by_name.get(name)
+                if metal is not None:
+                    events.append({"op": "metal", "data": metal})
+            for name in parties:
+                if name in data["parties"]:
+                    events.append({"op": "party", "name": name, "data": data["parties"][name]})
+            for index in sorted(set(history).union(range(start, len(data["history"])))):
+                events.append({"op": "history", "index": index, "data": data["history"][index]})
+            if expenses:
+                events.append({"op": "expenses", "data": data["expenses"]})
+            if events:
+                append_events(events)
+            self._history_logged = len(data["history"])
+    def compact(self, replace=False):
+        """دمج سجل WAL في data.json (replace عند استبدال البيانات كاملة)"""
+        self._compacted_version = self.data_version
+        payload = compact_data(self.data, replace)
+        self._history_logged = len(self.data["history"])
+        return payload
+    def maybe_backup(self):
+        """نسخة احتياطية واحدة لكل التعديلات منذ آخر نسخة، ولا شيء إذا لم تتغير البيانات"""
+        if self._backup_after_id is not None:
+            self.after_cancel(self._backup_after_id)
+            self._backup_after_id = None
+        if self.data_version != self._backup_version:
+            self.auto_backup()
+    def periodic_backup(self):
+        """حد أقصى للفترة بين النسخ أثناء العمل المتواصل"""
+        self._auto_backup_id = self.after(AUTO_BACKUP_INTERVAL_SECONDS * 1000, self.periodic_backup)
+        self.maybe_backup()
+    def auto_backup(self):
+        """أخذ لقطة متسقة من الخيط الرئيسي ثم ضغطها وكتابتها في الخلفية"""
+        self._backup_version = self.data_version
+        # اللقطة نفسها المكتوبة إلى data.json تُستخدم للنسخة الاحتياطية
+        payload = self.compact()
+        # الخيط لا يستدعي Tk، بل يعيد اسم الملف عبر طابور يقرؤه الخيط الرئيسي
+        self._backup_thread = threading.Thread(
+            target=lambda: self._backup_results.put(write_backup(payload)), daemon=True)
+        self._backup_thread.start()
+        self.after(100, self._poll_backup)
+    def _poll_backup(self):
+        """استلام نتائج النسخ الاحتياطية المكتملة وتحديث الواجهة"""
+        while True:
+            try:
+                filename = self._backup_results.get_nowait()
+            except queue.Empty:
+                break
+            if filename:
+                self._set_last_backup(filename)
+        if self._backup_thread.is_alive() or not self._backup_results.empty():
+            self.after(100, self._poll_backup)
+    def _set_last_backup(self, filename):
+        """تحديث اسم آخر نسخة احتياطية دون إعادة فحص مجلد النسخ"""
+        self._last_backup_name = os.path.basename(filename)
+        self.last_backup_label.config(text=f"آخر نسخة احتياطية: {backup_label(self._last_backup_name)}")
+    def inventory_value(self):
+        """إجمالي قيمة المخزون بسعر الشراء، محفوظ حتى الحفظ التالي لأي تعديل"""
+        version, value = self._inventory_value
+        if version != self.data_version:
+            value = sum(round(metal_total_quantity(m) * float(m.get("price_per_kg", 0.0)), 2)
+                        for m in self.data.get("metals", []))
+            self._inventory_value = (self.data_version, value)
+        return value
+    def reindex_metals(self):
+        """إعادة بناء فهرس اسم المعدن -> المعدن بترتيب القائمة (عند التكرار يفوز الأول كما في البحث الخطي)"""
+        by_name = self._by_name = {}
+        for m in self.data["metals"]:
+            by_name.setdefault(m["name"], m)
+        clear_metal_totals()
+    def get_metal(self, name):
+        """إرجاع المعدن بالاسم من الفهرس، أو None إذا لم يكن موجوداً"""
+        return self._by_name.get(name)
     def get_metal_names(self):
-        """إرجاع قائمة بأسماء المعادن الحالية من البيانات."""
-        return [m["name"] for m in self.data.get("metals", [])]
+        """إرجاع قائمة بأسماء المعادن الحالية من الفهرس (بدون تكرار)."""
+        return list(self._by_name)
     def apply_theme(self):
         """تطبيق النمط حسب الوضع (فاتح أو مظلم)"""
         if self.dark_mode:
@@ -500,26 +937,31 @@ class MetalInventoryApp(tk.Tk):
             # Toplevel windows background
             self.configure(bg=bg_main)
 
+        # الخط الافتراضي لكل أنماط ttk (الأنماط التي تحدد خطها الخاص تتجاوزه)
+        self.style.configure(".", font=("Cairo", 11))
+
     def toggle_theme(self):
         """تبديل بين الوضع المظلم والفاتح"""
         self.dark_mode = not self.dark_mode
         self.settings["dark_mode"] = self.dark_mode
         save_settings(self.settings)
         self.apply_theme()
+        # نافذة السجل المخفية يُعاد استخدامها، فتُحدَّث خلفيتها بالنمط الجديد
+        win = self._history_win
+        if win is not None and win.top.winfo_exists():
+            win.top.configure(bg="#1e1e2e" if self.dark_mode else "#f3f3f3")
         self.refresh_table()
     # -----------------------------------------------------------------
     # عند بدء التشغيل
     # -----------------------------------------------------------------
     def check_restore_on_start(self):
-        backups = sorted([f for f in os.listdir(BACKUP_DIR) if f.startswith("backup_")])
-        if backups:
-            latest = backups[-1]
+        latest = latest_backup()
+        if latest:
             latest_path = os.path.join(BACKUP_DIR, latest)
-            if messagebox.askyesno("استعادة", f"هل تريد استعادة آخر نسخة احتياطية ({latest})؟"):
+            if messagebox.askyesno("استعادة", f"هل تريد استعادة آخر نسخة احتياطية ({backup_label(latest)})؟"):
                 try:
-                    with open(latest_path, "r", encoding="utf-8") as f:
-                        self.data = json.load(f)
-                    save_data(self.data)
+                    self.data = normalize_data(read_json_file(latest_path))
+                    compact_data(self.data, replace=True)
                     messagebox.showinfo("تم", "تم استعادة النسخة الاحتياطية.")
                 except Exception as e:
                     messagebox.showerror("خطأ", f"فشل استعادة النسخة: {e}")
@@ -532,20 +974,21 @@ class MetalInventoryApp(tk.Tk):
         toolbar_frame.pack(fill=tk.X, padx=10, pady=5)
 
         # أزرار الأدوات - مع إضافة رموز ملونة وجذابة
-        self.btn_add_metal = ttk.Button(toolbar_frame, text="✨ إضافة معدن", command=self.open_add_metal_menu)
-        self.btn_add_stock = ttk.Button(toolbar_frame, text="📦 إضافة كمية", command=self.open_add_stock)
-        self.btn_remove_stock = ttk.Button(toolbar_frame, text="💰 بيع / سحب كمية", command=self.open_remove_stock)
-        self.btn_remove_metal = ttk.Button(toolbar_frame, text="🗑️ حذف معدن", command=self.remove_metal)
-        self.btn_history = ttk.Button(toolbar_frame, text="🕒 السجل", command=self.open_history_window)
-        self.btn_export = ttk.Button(toolbar_frame, text="⬇️ تصدير", command=self.export_data)
-        self.btn_import = ttk.Button(toolbar_frame, text="⬆️ استيراد", command=self.import_data)
-        self.btn_parties = ttk.Button(toolbar_frame, text="👥 الحسابات", command=self.open_parties_window)
-        self.btn_expenses = ttk.Button(toolbar_frame, text="💸 المصروفات", command=self.open_expenses_window)
-        self.btn_theme = ttk.Button(toolbar_frame, text="🌙/☀️ الوضع", command=self.toggle_theme)
+        buttons = [ttk.Button(toolbar_frame, text=text, command=command) for text, command in (
+            ("✨ إضافة معدن", self.open_add_metal_menu),
+            ("📦 إضافة كمية", self.open_add_stock),
+            ("💰 بيع / سحب كمية", self.open_remove_stock),
+            ("🗑️ حذف معدن", self.remove_metal),
+            ("🕒 السجل", self.open_history_window),
+            ("⬇️ تصدير", self.export_data),
+            ("⬆️ استيراد", self.import_data),
+            ("👥 الحسابات", self.open_parties_window),
+            ("💸 المصروفات", self.open_expenses_window),
+            ("🌙/☀️ الوضع", self.toggle_theme),
+        )]
 
         # ترتيب الأزرار من اليمين إلى اليسار
-        for w in [self.btn_theme, self.btn_expenses, self.btn_parties, self.btn_import, self.btn_export, self.btn_history, self.btn_remove_metal,
-                  self.btn_remove_stock, self.btn_add_stock, self.btn_add_metal]:
+        for w in reversed(buttons):
             w.pack(side=tk.RIGHT, padx=3)
 
         # شريط البحث
@@ -555,7 +998,9 @@ class MetalInventoryApp(tk.Tk):
         self.search_var = tk.StringVar()
         entry_search = ttk.Entry(search_frame, textvariable=self.search_var, justify="right")
         entry_search.pack(side=tk.RIGHT, fill=tk.X, expand=True, padx=(0, 5))
-        entry_search.bind("<KeyRelease>", lambda e: self.refresh_table())
+        self._search_after_id = None
+        self._last_query = ""
+        entry_search.bind("<KeyRelease>", self.on_search_key)
 
         # جدول المعادن
         main_frame = ttk.Frame(self)
@@ -601,9 +1046,26 @@ class MetalInventoryApp(tk.Tk):
     # -----------------------------------------------------------------
     def on_exit(self):
         """يسأل المستخدم عن النسخ الاحتياطي قبل الإغلاق"""
+        # عدم قطع كتابة نسخة احتياطية تلقائية جارية: إعادة المحاولة بعد قليل (مرة واحدة مهما تكرر النقر)
+        if self._exit_after_id is not None:
+            self.after_cancel(self._exit_after_id)
+            self._exit_after_id = None
+        if self._backup_thread is not None and self._backup_thread.is_alive():
+            self._exit_after_id = self.after(50, self.on_exit)
+            return
+        if self._exiting:
+            return
+        self._exiting = True
+        self.after_cancel(self._auto_backup_id)
+        if self._backup_after_id is not None:
+            self.after_cancel(self._backup_after_id)
+            self._backup_after_id = None
         if messagebox.askyesno("خروج", "هل ترغب في إنشاء نسخة احتياطية قبل الإغلاق؟"):
             make_backup(self.data)
             messagebox.showinfo("تم", "تم إنشاء نسخة احتياطية بنجاح.")
+        if self.data_version != self._compacted_version:
+            self.compact()
+        flush_data_writes()
         self.destroy()
     # -----------------------------------------------------------------
     # التعامل مع النقر على العناصر في الجدول
@@ -655,46 +1117,48 @@ class MetalInventoryApp(tk.Tk):
         self.wait_window(dialog.top)
         if dialog.result:
             name, qty, price, source, paid_amount, due_amount = dialog.result
-            existing = next((m for m in self.data["metals"] if m["name"]==name), None)
+            existing = self._by_name.get(name)
             if existing:
                 messagebox.showwarning("تحذير", "هذا المعدن موجود مسبقًا.")
                 return
+            ts = now_iso()  # توقيت واحد لكل سجلات العملية
+            # الحوار يعيد الأرقام محوَّلة مسبقاً، فالمبلغ الإجمالي يُحسب مرة واحدة
+            total_amount = round(qty * price, 2)
             m = {
                 "name": name,
-                "price_per_kg": float(price),
-                "sale_price_per_kg": float(price),
+                "price_per_kg": price,
+                "sale_price_per_kg": price,
                 "lots": [],
-                "last_updated": now_iso(),
+                "last_updated": ts,
                 "profit_total": 0.0
             }
-            if float(qty) > 0:
-                total_paid = round(float(qty) * float(price), 2)
+            if qty > 0:
                 m["lots"].append({
                     "source": source or "مصدر افتراضي",
-                    "quantity": float(qty),
-                    "total_paid": total_paid,
-                    "date": now_iso(),
-                    "price_per_kg": float(price)
+                    "quantity": qty,
+                    "total_paid": total_amount,
+                    "date": ts,
+                    "price_per_kg": price
                 })
             self.data["metals"].append(m)
-            # حساب المبلغ الإجمالي
-            total_amount = round(float(qty) * float(price), 2)
+            self._by_name[name] = m
             # إضافة تفصيل المعاملة
             transaction_details = {
+                "date": ts,
                 "operation": "إضافة معدن جديد",
                 "metal": name,
-                "quantity": float(qty),
-                "price_per_kg": float(price),
+                "quantity": qty,
+                "price_per_kg": price,
                 "total_price": total_amount,
                 "paid_amount": paid_amount,
                 "due_amount": due_amount
             }
             self.data["history"].append({
-                "date": now_iso(),
+                "date": ts,
                 "operation": "إضافة معدن جديد",
                 "metal": name,
-                "quantity": float(qty),
-                "price_per_kg": float(price),
+                "quantity": qty,
+                "price_per_kg": price,
                 "total_price": total_amount,
                 "person": source,
                 "paid_amount": paid_amount,
@@ -703,25 +1167,22 @@ class MetalInventoryApp(tk.Tk):
             })
             # تحديث رصيد المورد وإضافة تفصيل المعاملة
             update_party_balance(self.data["parties"], source, due_amount, "purchase", is_supplier=True, transaction_details=transaction_details)
-            save_data(self.data)
-            make_backup(self.data)
+            self.persist(metals=(name,), parties=(source,))
             self.refresh_table()
     def open_add_stock(self):
         dialog = AddStockDialog(self, self.get_metal_names(), self.data.get("parties", {}))
         self.wait_window(dialog.top)
         if dialog.result:
             name, qty, buy_price, source, paid_amount, due_amount = dialog.result
-            metal = next((m for m in self.data["metals"] if m["name"]==name), None)
+            metal = self._by_name.get(name)
             if not metal:
                 messagebox.showerror("خطأ", "المعدن غير موجود.")
                 return
-            qty = float(qty)
             current_total_qty = metal_total_quantity(metal)
             if buy_price is None:
                 # إذا لم يتم تحديد سعر شراء، نستخدم السعر الحالي
                 buy_price = float(metal.get("price_per_kg", 0.0))
-            else:
-                buy_price = float(buy_price)
+            ts = now_iso()  # توقيت واحد لكل سجلات العملية
             total_amount = round(qty * buy_price, 2)
             # إذا كان المخزون الحالي صفرًا، نقوم بتحديث السعر الرئيسي
             if current_total_qty == 0:
@@ -732,15 +1193,17 @@ class MetalInventoryApp(tk.Tk):
                 "source": source or "مصدر افتراضي",
                 "quantity": qty,
                 "total_paid": total_amount,
-                "date": now_iso(),
+                "date": ts,
                 "price_per_kg": buy_price
             }
             metal["lots"].append(new_lot)
+            invalidate_metal_totals(metal)
             # دمج الدفعات التي لها نفس السعر
             combine_lots_with_same_price(metal)
-            metal["last_updated"] = now_iso()
+            metal["last_updated"] = ts
             # إضافة تفصيل المعاملة
             transaction_details = {
+                "date": ts,
                 "operation": "إضافة كمية",
                 "metal": name,
                 "quantity": qty,
@@ -750,7 +1213,7 @@ class MetalInventoryApp(tk.Tk):
                 "due_amount": due_amount
             }
             self.data["history"].append({
-                "date": now_iso(),
+                "date": ts,
                 "operation": "إضافة كمية",
                 "metal": name,
                 "quantity": qty,
@@ -763,8 +1226,7 @@ class MetalInventoryApp(tk.Tk):
             })
             # تحديث رصيد المورد وإضافة تفصيل المعاملة
             update_party_balance(self.data["parties"], source, due_amount, "purchase", is_supplier=True, transaction_details=transaction_details)
-            save_data(self.data)
-            make_backup(self.data)
+            self.persist(metals=(name,), parties=(source,))
             self.refresh_table()
     def open_remove_stock(self):
         dialog = RemoveStockDialog(self, self.get_metal_names(), self.data.get("parties", {}))
@@ -780,22 +1242,22 @@ class MetalInventoryApp(tk.Tk):
                 # معاملة واحدة
                 if dialog.result:
                     self.process_single_transaction(dialog.result)
-            save_data(self.data)
-            make_backup(self.data)
+            transactions = dialog.result if isinstance(dialog.result, list) else [dialog.result]
+            transactions = [t for t in transactions if t]
+            self.persist(metals={t[0] for t in transactions}, parties={t[3] for t in transactions})
             self.refresh_table()
     def process_single_transaction(self, transaction):
         """معالجة معاملة واحدة للبيع"""
         name, qty, sale_price, person, paid_amount, due_amount, lot_index = transaction
-        metal = next((m for m in self.data["metals"] if m["name"]==name), None)
+        metal = self._by_name.get(name)
         if not metal:
             messagebox.showerror("خطأ", "المعدن غير موجود.")
             return
-        qty = float(qty)
         total_available = metal_total_quantity(metal)
         if qty > total_available:
             messagebox.showerror("خطأ", "الكمية المسحوبة أكبر من المتوفر.")
             return
-        revenue = round(qty * float(sale_price), 2)
+        revenue = round(qty * sale_price, 2)
         try:
             if lot_index is not None:
                 # خصم من دفعة محددة
@@ -809,14 +1271,15 @@ class MetalInventoryApp(tk.Tk):
         profit = round(revenue - cost_basis, 2)
         profit_percentage = round((profit / revenue * 100) if revenue > 0 else 0, 2)
         metal["profit_total"] = round(metal.get("profit_total", 0.0) + profit, 2)
-        metal["last_updated"] = now_iso()
-        total_amount = round(qty * float(sale_price), 2)
+        ts = now_iso()  # توقيت واحد لكل سجلات العملية
+        metal["last_updated"] = ts
         # إضافة تفصيل المعاملة
         transaction_details = {
+            "date": ts,
             "operation": "بيع / سحب كمية",
             "metal": name,
             "quantity": qty,
-            "price_per_kg": float(sale_price),
+            "price_per_kg": sale_price,
             "total_price": revenue,
             "cost_basis": cost_basis,
             "profit": profit,
@@ -824,11 +1287,11 @@ class MetalInventoryApp(tk.Tk):
             "due_amount": due_amount
         }
         self.data["history"].append({
-            "date": now_iso(),
+            "date": ts,
             "operation": "بيع / سحب كمية",
             "metal": name,
             "quantity": qty,
-            "price_per_kg": float(sale_price),
+            "price_per_kg": sale_price,
             "total_price": revenue,
             "person": person,
             "cost_basis": cost_basis,
@@ -868,9 +1331,11 @@ class MetalInventoryApp(tk.Tk):
                 return
             # حذف المعدن من البيانات فقط
             self.data["metals"] = [m for m in self.data["metals"] if m["name"] != selected_name]
+            removed = self._by_name.pop(selected_name, None)
+            if removed is not None:
+                invalidate_metal_totals(removed)
             # لا نحذف السجلات أو الحسابات
-            save_data(self.data)
-            make_backup(self.data)
+            self.persist(deleted_metals=(selected_name,))
             self.refresh_table()
             messagebox.showinfo("تم", f"تم حذف المعدن '{selected_name}' بنجاح.")
             top.destroy()
@@ -879,7 +1344,14 @@ class MetalInventoryApp(tk.Tk):
         ttk.Button(btn_frame, text="🗑️ حذف", command=delete_selected).pack(side=tk.RIGHT, padx=5)
         ttk.Button(btn_frame, text="❌ إلغاء", command=top.destroy).pack(side=tk.RIGHT, padx=5)
     def open_history_window(self):
-        HistoryWindow(self, self.data.get("history", []))
+        # إعادة استخدام نافذة السجل المخفية بدلاً من بنائها وملئها من جديد
+        win = self._history_win
+        if win is not None and win.top.winfo_exists():
+            win.refresh(self.data.get("history", []))
+            win.top.deiconify()
+            win.top.lift()
+            return
+        self._history_win = HistoryWindow(self, self.data.get("history", []))
     def open_parties_window(self):
         PartiesWindow(self, self.data.get("parties", {}))
     def open_expenses_window(self):
@@ -889,8 +1361,8 @@ class MetalInventoryApp(tk.Tk):
         if not path:
             return
         try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(self.data, f, ensure_ascii=False, indent=2)
+            with open(path, "wb") as f:
+                f.write(json_dumps(self.data, pretty=True))
             messagebox.showinfo("تم", "تم تصدير البيانات.")
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل التصدير: {e}")
@@ -901,12 +1373,11 @@ class MetalInventoryApp(tk.Tk):
         if not messagebox.askyesno("تأكيد", "سيتم استبدال جميع البيانات الحالية. هل ترغب بالمتابعة؟"):
             return
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                d = json.load(f)
+            d = read_json_file(path)
             if "metals" in d and "history" in d and "parties" in d and "expenses" in d:
-                self.data = d
-                save_data(self.data)
-                make_backup(self.data)
+                self.data = normalize_data(d)
+                self.reindex_metals()
+                self.persist(full=True)
                 self.refresh_table()
                 messagebox.showinfo("تم", "تم استيراد البيانات.")
             else:
@@ -917,28 +1388,23 @@ class MetalInventoryApp(tk.Tk):
     # عرض التفاصيل والتعديل
     # -----------------------------------------------------------------
     def refresh_table(self):
-        q = self.search_var.get().strip()
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-        total_value = 0.0
-        total_profit = 0.0
-        total_revenue = 0.0
+        q = normalize_search(self.search_var.get().strip())
+        rows = {}  # iid -> (الأب, القيم) بالترتيب المطلوب للعرض
+        shown = []  # المعادن المطابقة للبحث
         # حساب إجمالي المصروفات
         total_expenses = sum(e.get("amount", 0) for e in self.data.get("expenses", []))
         for m in self.data.get("metals", []):
             name = m.get("name","")
-            if q and q not in name:
+            if q and q not in metal_search_text(m):
                 continue
             qty = metal_total_quantity(m)
             buy_price = float(m.get("price_per_kg", 0.0))  # تعديل: استخدام سعر الشراء
             value = round(qty * buy_price, 2)  # تعديل: حساب القيمة بسعر الشراء
-            total_value += value
-            # تجميع الربح الإجمالي من المعادن فقط
-            total_profit += float(m.get("profit_total", 0.0))
+            shown.append(m)
             last = m.get("last_updated","")
             sources_count = len(m.get("lots", []))
             # إضافة المعدن الرئيسي
-            self.tree.insert("", "end", iid=name, values=(name, qty, buy_price, value, last, sources_count))
+            rows[name] = ("", (name, qty, buy_price, value, last, sources_count))
 
             # إذا كان العنصر مفتوحًا لعرض الدفعات
             if name in self.expanded_metals:
@@ -949,7 +1415,7 @@ class MetalInventoryApp(tk.Tk):
                     lot_date = lot.get("date", "")
                     lot_id = f"lot_{name}_{idx}"
                     # إضافة الدفعة كسطر فرعي
-                    self.tree.insert(name, "end", iid=lot_id, values=(
+                    rows[lot_id] = (name, (
                         f"↳ {lot.get('source', 'مصدر افتراضي')} @ {lot_price} جنيه",
                         lot_qty,
                         lot_price,
@@ -957,8 +1423,49 @@ class MetalInventoryApp(tk.Tk):
                         lot_date,
                         ""
                     ))
-                    # جعل السطر فرعيًا
-                    self.tree.item(lot_id, tags=('subitem',))
+        # قيمة المخزون تشمل كل المعادن بغض النظر عن البحث، فتُحسب فقط عند تغير البيانات
+        total_value = self.inventory_value()
+        # تجميع الربح الإجمالي من المعادن فقط
+        total_profit = sum(float(m.get("profit_total", 0.0)) for m in shown)
+
+        # تحديث الجدول بالفروقات فقط بدلاً من حذف وإعادة إدراج كل الصفوف
+        old = self._row_cache
+        # حذف المعدن يحذف دفعاته معه
+        stale = [iid for iid, (parent, _) in old.items() if iid not in rows and (not parent or parent in rows)]
+        # الآباء الذين تغير فيهم الترتيب النسبي للصفوف الباقية، فتُنقل صفوفهم إلى مواضعها الجديدة
+        old_order = defaultdict(list)
+        new_order = defaultdict(list)
+        for iid, (parent, _) in old.items():
+            if iid in rows:
+                old_order[parent].append(iid)
+        for iid, (parent, _) in rows.items():
+            if iid in old:
+                new_order[parent].append(iid)
+        reordered = {parent for parent, iids in new_order.items() if old_order[parent] != iids}
+        # إخفاء الجدول أثناء التغييرات الكبيرة حتى لا يُعاد حساب تخطيطه مع كل صف
+        detach = len(stale) + len(rows.keys() - old.keys()) >= TREE_DETACH_MIN_ROWS
+        if detach:
+            self.tree.pack_forget()
+        try:
+            if stale:
+                self.tree.delete(*stale)
+            positions = {}
+            for iid, (parent, values) in rows.items():
+                index = positions.get(parent, 0)
+                positions[parent] = index + 1
+                prev = old.get(iid)
+                if prev is None:
+                    # جعل سطر الدفعة فرعيًا
+                    self.tree.insert(parent, index, iid=iid, values=values, tags=("subitem",) if parent else ())
+                    continue
+                if parent in reordered:
+                    self.tree.move(iid, parent, index)
+                if prev[1] != values:
+                    self.tree.item(iid, values=values)
+        finally:
+            if detach:
+                self.tree.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
+        self._row_cache = rows
 
         # تطبيق التنسيق على العناصر الفرعية - Use theme colors for subitems
         if self.dark_mode:
@@ -968,9 +1475,8 @@ class MetalInventoryApp(tk.Tk):
         self.tree.tag_configure('subitem', background=subitem_bg)
 
         # حساب إجمالي الأرباح ونسبة الربح من السجلات (لحسابات النسب المئوية)
-        for h in self.data.get("history", []):
-            if h.get("transaction_type") == "sale":
-                total_revenue += h.get("total_price", 0)
+        total_revenue = sum(h.get("total_price", 0) for h in self.data.get("history", [])
+                            if h.get("transaction_type") == "sale")
 
         profit_percentage = round((total_profit / total_revenue * 100) if total_revenue > 0 else 0, 2)
         # حساب صافي الربح (الإيرادات - المصروفات) أو (إجمالي الربح من المعادن - المصروفات)
@@ -979,20 +1485,33 @@ class MetalInventoryApp(tk.Tk):
         self.total_value_label.config(text=f"إجمالي قيمة المخزون (سعر الشراء): {round(total_value,2)} جنيه")
         # عرض صافي الربح في التسمية
         self.total_profit_label.config(text=f"صافي الربح: {round(net_profit,2)} جنيه ({net_profit_percentage}%)")
-        backups = sorted([f for f in os.listdir(BACKUP_DIR) if f.startswith("backup_")])
-        last = backups[-1] if backups else "-"
+        last = backup_label(self._last_backup_name) if self._last_backup_name else "-"
         self.last_backup_label.config(text=f"آخر نسخة احتياطية: {last}")
 
+    def on_search_key(self, event=None):
+        """تأجيل تحديث الجدول حتى يتوقف المستخدم عن الكتابة"""
+        if self._search_after_id:
+            self.after_cancel(self._search_after_id)
+        self._search_after_id = self.after(150, self.apply_search)
+    def apply_search(self):
+        """تطبيق البحث إذا تغير النص فعلاً"""
+        self._search_after_id = None
+        q = self.search_var.get().strip()
+        if q == self._last_query:
+            return
+        self._last_query = q
+        self.refresh_table()
     def on_item_double_click(self, event):
         item = self.tree.focus()
         if not item:
             return
         # إذا كان العنصر هو دفعة، نحصل على اسم المعدن الرئيسي
         if item.startswith("lot_"):
-            name = item.split("_", 2)[1]
+            # اسم المعدن هو الأب مباشرة (قد يحتوي الاسم نفسه على "_")
+            name = self.tree.parent(item)
         else:
             name = item
-        metal = next((m for m in self.data["metals"] if m["name"]==name), None)
+        metal = self._by_name.get(name)
         if not metal:
             return
         top = tk.Toplevel(self)
@@ -1056,8 +1575,7 @@ class MetalInventoryApp(tk.Tk):
                 metal["price_per_kg"] = float(e_buy.get())
                 metal["sale_price_per_kg"] = float(e_sell.get())
                 metal["last_updated"] = now_iso()
-                save_data(self.data)
-                make_backup(self.data)
+                self.persist(metals=(metal["name"],))
                 self.refresh_table()
                 top.destroy()
                 if parent_window:
@@ -1075,17 +1593,18 @@ class MetalInventoryApp(tk.Tk):
         if not path:
             return
         try:
-            with open(path, "w", encoding="utf-8", newline='') as f:
+            default_price = metal.get("price_per_kg", 0.0)
+            rows = [(
+                l.get("source"),
+                l.get("quantity"),
+                l.get("price_per_kg", default_price),
+                l.get("total_paid"),
+                l.get("date")
+            ) for l in metal.get("lots", [])]
+            with open(path, "w", encoding="utf-8", newline='', buffering=EXPORT_BUFFER_SIZE) as f:
                 writer = csv.writer(f)
                 writer.writerow(["المصدر","الكمية (كجم)","سعر الشراء (جنيه/كجم)","المبلغ المدفوع (جنيه)","تاريخ الإضافة"])
-                for l in metal.get("lots", []):
-                    writer.writerow([
-                        l.get("source"),
-                        l.get("quantity"),
-                        l.get("price_per_kg", metal.get("price_per_kg", 0.0)),
-                        l.get("total_paid"),
-                        l.get("date")
-                    ])
+                writer.writerows(rows)
             messagebox.showinfo("تم", "تم تصدير البيانات.")
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل التصدير: {e}")
@@ -1174,12 +1693,12 @@ class AddMetalDialog:
         if not name or not price:
             messagebox.showerror("خطأ", "يرجى إدخال الاسم والسعر.")
             return
-        try:
-            float(qty); float(price); float(paid); float(due)
-        except:
+        numbers = [parse_number(v) for v in (qty, price, paid, due)]
+        if None in numbers:
             messagebox.showerror("خطأ", "قيمة رقمية غير صحيحة.")
             return
-        self.result = (name, qty, price, source, float(paid), float(due))
+        qty, price, paid, due = numbers
+        self.result = (name, qty, price, source, paid, due)
         self.top.destroy()
     def on_cancel(self):
         self.top.destroy()
@@ -1264,12 +1783,12 @@ class AddStockDialog:
         if not name or not qty or not price:
             messagebox.showerror("خطأ", "يرجى ملء كل الحقول المطلوبة.")
             return
-        try:
-            float(qty); float(price); float(paid); float(due)
-        except:
+        numbers = [parse_number(v) for v in (qty, price, paid, due)]
+        if None in numbers:
             messagebox.showerror("خطأ", "قيمة رقمية خاطئة.")
             return
-        self.result = (name, qty, float(price), source, float(paid), float(due))
+        qty, price, paid, due = numbers
+        self.result = (name, qty, price, source, paid, due)
         self.top.destroy()
     def on_cancel(self):
         self.top.destroy()
@@ -1377,7 +1896,7 @@ class RemoveStockDialog:
             self.lot_var.set("")
             self.e_qty.delete(0, tk.END) # Clear quantity field
             return
-        metal = next((m for m in self.parent.data["metals"] if m["name"] == metal_name), None)
+        metal = self.parent.get_metal(metal_name)
         if not metal:
              # This shouldn't happen if metal_name came from the metal combobox
             self.cmb_lot['values'] = []
@@ -1436,14 +1955,11 @@ class RemoveStockDialog:
         if not name or not qty_str or not price_str:
             messagebox.showerror("خطأ", "يرجى ملء كل الحقول المطلوبة (المعدن، الكمية، سعر البيع).")
             return
-        try:
-            qty = float(qty_str)
-            price = float(price_str)
-            paid = float(paid_str)
-            due = float(due_str)
-        except ValueError:
+        numbers = [parse_number(v) for v in (qty_str, price_str, paid_str, due_str)]
+        if None in numbers:
             messagebox.showerror("خطأ", "يرجى التأكد من أن القيم المدخلة صحيحة.")
             return
+        qty, price, paid, due = numbers
         if qty <= 0:
              messagebox.showerror("خطأ", "يجب أن تكون الكمية أكبر من صفر.")
              return
@@ -1470,9 +1986,9 @@ class RemoveStockDialog:
                     return # User cancelled the split, so cancel the whole operation
         else:
             # No specific lot selected, need to check total available quantity across all lots
-            metal = next((m for m in self.parent.data["metals"] if m["name"] == name), None)
+            metal = self.parent.get_metal(name)
             if metal:
-                total_available = sum(l.get("quantity", 0) for l in metal.get("lots", []))
+                total_available = metal_total_quantity(metal)
                 if qty > total_available:
                     messagebox.showerror("خطأ", f"الكمية المطلوبة ({qty}) أكبر من الكمية الإجمالية المتوفرة ({total_available}).")
                     return
@@ -1480,11 +1996,11 @@ class RemoveStockDialog:
                  messagebox.showerror("خطأ", "المعدن المحدد غير موجود.")
                  return
         # If we reach here, the single transaction is valid
-        self.result = (name, qty_str, price, person, paid, due, lot_index)
+        self.result = (name, qty, price, person, paid, due, lot_index)
         self.top.destroy()
     def split_quantity_over_lots(self, metal_name, total_qty, sale_price, person, paid_amount, due_amount):
         """Handles splitting a sale across multiple lots (FIFO)."""
-        metal = next((m for m in self.parent.data["metals"] if m["name"] == metal_name), None)
+        metal = self.parent.get_metal(metal_name)
         if not metal:
             messagebox.showerror("خطأ", "المعدن المحدد غير موجود.")
             return None
@@ -1525,6 +2041,9 @@ class RemoveStockDialog:
     def on_cancel(self):
         self.top.destroy()
 class HistoryWindow:
+    # أعمدة جدول السجل وعناوينها بالترتيب نفسه
+    COLS = HISTORY_COLS
+    HEADINGS = HISTORY_HEADINGS_AR
     def __init__(self, parent, history):
         top = self.top = tk.Toplevel(parent)
         top.title("🕒 السجل - Metalica")
@@ -1554,31 +2073,16 @@ class HistoryWindow:
         # إطار الأدوات
         tool_frame = ttk.Frame(top)
         tool_frame.pack(fill=tk.X, padx=6, pady=6)
-        ttk.Button(tool_frame, text="📄 تصدير CSV", command=lambda: self.export_csv(history)).pack(side=tk.LEFT, padx=4)
-        ttk.Button(tool_frame, text="📄 تصدير JSON", command=lambda: self.export_json(history)).pack(side=tk.LEFT, padx=4)
-        ttk.Button(tool_frame, text="✏️ تعديل سجل", command=lambda: self.edit_history_entry(history)).pack(side=tk.LEFT, padx=4)
+        ttk.Button(tool_frame, text="📄 تصدير CSV", command=lambda: self.export_csv(self.history)).pack(side=tk.LEFT, padx=4)
+        ttk.Button(tool_frame, text="📄 تصدير JSON", command=lambda: self.export_json(self.history)).pack(side=tk.LEFT, padx=4)
+        ttk.Button(tool_frame, text="✏️ تعديل سجل", command=lambda: self.edit_history_entry(self.history)).pack(side=tk.LEFT, padx=4)
 
         # جدول السجل
-        cols = ("date","operation","metal","quantity","price_per_kg","total_price","person","paid_amount","due_amount","cost_basis","profit","profit_percentage")
-        headers_ar = {
-            "date":"التاريخ",
-            "operation":"العملية",
-            "metal":"المعدن",
-            "quantity":"الكمية",
-            "price_per_kg":"السعر لكل كجم",
-            "total_price":"القيمة الإجمالية",
-            "person":"الطرف",
-            "paid_amount":"المبلغ المدفوع",
-            "due_amount":"المبلغ المتبقي",
-            "cost_basis":"تكلفة الشراء",
-            "profit":"الربح",
-            "profit_percentage":"نسبة الربح (%)"
-        }
         tree_frame = ttk.Frame(top)
         tree_frame.pack(fill=tk.BOTH, expand=True, padx=6, pady=6)
-        self.tree = ttk.Treeview(tree_frame, columns=cols, show="headings", height=15)
-        for c in cols:
-            self.tree.heading(c, text=headers_ar.get(c,c))
+        self.tree = ttk.Treeview(tree_frame, columns=self.COLS, show="headings", height=15)
+        for c, h in zip(self.COLS, self.HEADINGS):
+            self.tree.heading(c, text=h)
             self.tree.column(c, anchor="center", width=100)
         vsb = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
         hsb = ttk.Scrollbar(tree_frame, orient="horizontal", command=self.tree.xview)
@@ -1588,18 +2092,55 @@ class HistoryWindow:
         self.tree.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
 
         # ملء الجدول
-        for i, h in enumerate(history):
-            self.tree.insert("", "end", iid=i, values=(
-                h.get("date"), h.get("operation"), h.get("metal"), h.get("quantity"),
-                h.get("price_per_kg"), h.get("total_price"), h.get("person"),
-                h.get("paid_amount",""), h.get("due_amount",""), h.get("cost_basis",""),
-                h.get("profit",""), h.get("profit_percentage","")
-            ))
+        # صفوف القيم تُحسب مرة واحدة وتُستخدم للعرض وللتصدير CSV
+        self.rows = [history_row(h) for h in history]
+        self.parent = parent
+        # الملء على دفعات حتى تظهر النافذة فورًا مهما طال السجل
+        self._fill_pos = 0
+        self._fill_pending = False
+        self._fill_chunk()
+        # الإغلاق يخفي النافذة فقط حتى يُعاد استخدامها عند الفتح التالي
+        top.protocol("WM_DELETE_WINDOW", top.withdraw)
 
         # عند النقر على اسم العميل أو المورد، عرض سجل المعاملات معه
         self.tree.bind("<Double-1>", self.on_person_click)
         self.history = history
-        self.parent = parent
+        self._data_version = parent.data_version  # إصدار البيانات المعروض في الجدول
+    def _fill_chunk(self):
+        """إدراج الدفعة التالية من صفوف السجل ثم جدولة ما بعدها عند خمول الواجهة"""
+        self._fill_pending = False
+        if not self.tree.winfo_exists():
+            return  # أُغلقت النافذة قبل اكتمال الملء
+        start = self._fill_pos
+        end = min(start + (HISTORY_FILL_CHUNK if start else HISTORY_FIRST_PAGE), len(self.rows))
+        tree_insert_rows(self.tree, self.rows[start:end], start)
+        self._fill_pos = end
+        if end < len(self.rows):
+            self._fill_pending = True
+            self.parent.after_idle(self._fill_chunk)
+    def refresh(self, history):
+        """تحديث الجدول عند إعادة فتح النافذة: تعديل الصفوف المتغيرة وإضافة الجديدة فقط"""
+        version = self.parent.data_version
+        if history is self.history and version == self._data_version:
+            return  # لم يُحفظ أي تعديل منذ آخر عرض
+        self._data_version = version
+        if history is not self.history or len(history) < len(self.rows):
+            # السجل استُبدل (استيراد أو استعادة): إعادة الملء بالكامل
+            self.history = history
+            self.tree.delete(*self.tree.get_children())
+            self.rows = [history_row(h) for h in history]
+            self._fill_pos = 0
+        else:
+            rows = self.rows
+            for i, h in enumerate(history[:len(rows)]):
+                row = history_row(h)
+                if row != rows[i]:
+                    rows[i] = row
+                    if i < self._fill_pos:
+                        self.tree.item(i, values=row)
+            self.sync_rows(history)
+        if not self._fill_pending and self._fill_pos < len(self.rows):
+            self._fill_chunk()
     def on_person_click(self, event):
         item = self.tree.focus()
         if not item:
@@ -1656,20 +2197,9 @@ class HistoryWindow:
         ttk.Label(frm, text=f"العميل/المورد: {person_name}", font=("Cairo", 14, "bold")).grid(row=0, column=0, sticky="w")
         ttk.Label(frm, text=f"الرصيد المتبقي: {total_due} جنيه").grid(row=1, column=0, sticky="w")
 
-        cols = ("date","operation","metal","quantity","total_price","paid_amount","due_amount","profit")
-        headers_ar = {
-            "date":"التاريخ",
-            "operation":"العملية",
-            "metal":"المعدن",
-            "quantity":"الكمية",
-            "total_price":"القيمة الإجمالية",
-            "paid_amount":"المبلغ المدفوع",
-            "due_amount":"المبلغ المتبقي",
-            "profit":"الربح"
-        }
-        tree = ttk.Treeview(frm, columns=cols, show="headings", height=10)
-        for c in cols:
-            tree.heading(c, text=headers_ar.get(c,c))
+        tree = ttk.Treeview(frm, columns=PARTY_TX_COLS, show="headings", height=10)
+        for c in PARTY_TX_COLS:
+            tree.heading(c, text=HISTORY_HEADERS_AR[c])
             tree.column(c, anchor="center", width=100)
         tree.grid(row=2, column=0, columnspan=3, pady=8, sticky="nsew")
 
@@ -1686,25 +2216,112 @@ class HistoryWindow:
         path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv")])
         if not path:
             return
+        self.sync_rows(history)
+        self._start_export(self._do_export_csv, path, list(self.rows))
+    def sync_rows(self, history):
+        """إضافة صفوف العمليات التي أُضيفت للسجل بعد فتح النافذة"""
+        if len(self.rows) < len(history):
+            self.rows.extend(history_row(h) for h in history[len(self.rows):])
+    def _start_export(self, worker, path, items):
+        """عرض نافذة تقدّم مع زر إلغاء وتشغيل التصدير في خيط منفصل حتى لا تتجمد الواجهة"""
+        win = self._export_win = tk.Toplevel(self.top)
+        win.title("⏳ جارٍ التصدير")
+        win.transient(self.top)
+        win.grab_set()
+        win.configure(bg=self.top.cget("bg"))
+        self._export_cancel = threading.Event()
+        self._export_q = queue.Queue()  # رسائل خيط التصدير، يقرؤها الخيط الرئيسي
+        self._export_done = 0
+        ttk.Label(win, text=f"جارٍ تصدير {len(items)} سجل...", font=("Cairo", 10, "bold")).pack(padx=10, pady=(10, 5))
+        self._export_bar = ttk.Progressbar(win, mode="determinate", maximum=max(len(items), 1), length=300)
+        self._export_bar.pack(padx=10, pady=5)
+        ttk.Button(win, text="❌ إلغاء", command=self._export_cancel.set).pack(pady=(5, 10))
+        win.protocol("WM_DELETE_WINDOW", self._export_cancel.set)
+        threading.Thread(target=worker, args=(path, items, self._export_cancel), daemon=True).start()
+        self.top.after(50, self._poll_export)
+    def _poll_export(self):
+        """تطبيق رسائل خيط التصدير في الخيط الرئيسي (الخيط نفسه لا يستدعي Tk)"""
+        while True:
+            try:
+                msg = self._export_q.get_nowait()
+            except queue.Empty:
+                break
+            if msg[0] == "progress":
+                self._export_progress(msg[1])
+            else:
+                self._export_finished(*msg[1:])
+                return
+        self.top.after(50, self._poll_export)
+    def _export_progress(self, count):
+        """تقديم شريط التقدّم (يُستدعى في الخيط الرئيسي)"""
+        self._export_done += count
+        if self._export_bar.winfo_exists():
+            self._export_bar["value"] = self._export_done
+    def _export_finished(self, path, cancelled, error, done_msg):
+        """إغلاق نافذة التقدّم وإبلاغ المستخدم بنتيجة التصدير (يُستدعى في الخيط الرئيسي)"""
+        if self._export_win.winfo_exists():
+            self._export_win.destroy()
+        if error is not None:
+            messagebox.showerror("خطأ", f"فشل التصدير: {error}")
+        elif cancelled:
+            # حذف الملف الناقص
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            messagebox.showinfo("تم", "تم إلغاء التصدير.")
+        else:
+            messagebox.showinfo("تم", done_msg)
+    def _do_export_csv(self, path, rows, cancel):
+        """كتابة السجل CSV على دفعات (يعمل خارج الخيط الرئيسي)"""
+        error = None
         try:
-            with open(path, "w", encoding="utf-8", newline='') as f:
+            with open(path, "w", encoding="utf-8", newline='', buffering=EXPORT_BUFFER_SIZE) as f:
                 writer = csv.writer(f)
-                writer.writerow(["التاريخ","العملية","المعدن","الكمية","السعر لكل كجم","القيمة الإجمالية","الطرف","المبلغ المدفوع","المبلغ المتبقي","تكلفة الشراء","الربح","نسبة الربح (%)"])
-                for h in history:
-                    writer.writerow([h.get("date"),h.get("operation"),h.get("metal"),h.get("quantity"),h.get("price_per_kg"),h.get("total_price"),h.get("person"),h.get("paid_amount",""),h.get("due_amount",""),h.get("cost_basis",""),h.get("profit",""),h.get("profit_percentage","")])
-            messagebox.showinfo("تم", "تم تصدير السجل CSV.")
+                writer.writerow(HISTORY_HEADINGS_AR)
+                for start in range(0, len(rows), EXPORT_CHUNK_SIZE):
+                    if cancel.is_set():
+                        break
+                    chunk = rows[start:start + EXPORT_CHUNK_SIZE]
+                    text = format_csv_rows(chunk, HISTORY_CSV_LINE, len(HISTORY_COLS))
+                    if text is None:
+                        writer.writerows(chunk)
+                    else:
+                        f.write(text)
+                    f.flush()
+                    self._export_q.put(("progress", len(chunk)))
         except Exception as e:
-            messagebox.showerror("خطأ", f"فشل التصدير: {e}")
+            error = e
+        self._export_q.put(("done", path, cancel.is_set(), error, "تم تصدير السجل CSV."))
     def export_json(self, history):
         path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON","*.json")])
         if not path:
             return
+        self._start_export(self._do_export_json, path, list(history))
+    def _do_export_json(self, path, history, cancel):
+        """كتابة السجل JSON صفًا بصف على دفعات (يعمل خارج الخيط الرئيسي)"""
+        error = None
         try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(history, f, ensure_ascii=False, indent=2)
-            messagebox.showinfo("تم", "تم تصدير السجل JSON.")
+            with open(path, "wb", buffering=EXPORT_BUFFER_SIZE) as f:
+                if len(history) < JSON_PRETTY_MAX_ROWS:
+                    # السجلات الصغيرة تُكتب بتنسيق مقروء في عملية كتابة واحدة
+                    f.write(json_dumps(history, pretty=True))
+                    self._export_q.put(("progress", len(history)))
+                else:
+                    f.write(b"[\n")
+                    for start in range(0, len(history), EXPORT_CHUNK_SIZE):
+                        if cancel.is_set():
+                            break
+                        chunk = history[start:start + EXPORT_CHUNK_SIZE]
+                        if start:
+                            f.write(b",\n")
+                        f.write(b",\n".join(map(json_dumps, chunk)))
+                        f.flush()
+                        self._export_q.put(("progress", len(chunk)))
+                    f.write(b"\n]")
         except Exception as e:
-            messagebox.showerror("خطأ", f"فشل التصدير: {e}")
+            error = e
+        self._export_q.put(("done", path, cancel.is_set(), error, "تم تصدير السجل JSON."))
     def edit_history_entry(self, history):
         """نافذة لتعديل سجل العمليات"""
         selected_item = self.tree.focus()
@@ -1737,19 +2354,8 @@ class HistoryWindow:
         # حقول التعديل
         fields = {}
         row = 0
-        for label, field in [("التاريخ:", "date"),
-                            ("العملية:", "operation"),
-                            ("المعدن:", "metal"),
-                            ("الكمية:", "quantity"),
-                            ("السعر لكل كجم:", "price_per_kg"),
-                            ("القيمة الإجمالية:", "total_price"),
-                            ("الطرف:", "person"),
-                            ("المبلغ المدفوع:", "paid_amount"),
-                            ("المبلغ المتبقي:", "due_amount"),
-                            ("تكلفة الشراء:", "cost_basis"),
-                            ("الربح:", "profit"),
-                            ("نسبة الربح (%):", "profit_percentage")]:
-            ttk.Label(edit_window, text=label, font=("Cairo", 10, "bold")).grid(row=row, column=1, sticky="e", padx=5, pady=2)
+        for field in HISTORY_COLS:
+            ttk.Label(edit_window, text=HISTORY_HEADERS_AR[field] + ":", font=("Cairo", 10, "bold")).grid(row=row, column=1, sticky="e", padx=5, pady=2)
             entry_field = ttk.Entry(edit_window, justify="right")
             entry_field.grid(row=row, column=0, padx=5, pady=2)
             entry_field.insert(0, str(entry.get(field, "")))
@@ -1760,17 +2366,13 @@ class HistoryWindow:
             try:
                 # تحديث البيانات
                 for key in fields:
-                    if key in ["quantity", "price_per_kg", "total_price", "paid_amount", "due_amount", "cost_basis", "profit", "profit_percentage"]:
+                    if key in HISTORY_NUMERIC_FIELDS:
                         entry[key] = float(fields[key].get())
                     else:
                         entry[key] = fields[key].get()
                 # تحديث العرض
-                self.tree.item(selected_item, values=(
-                    entry.get("date"), entry.get("operation"), entry.get("metal"), entry.get("quantity"),
-                    entry.get("price_per_kg"), entry.get("total_price"), entry.get("person"),
-                    entry.get("paid_amount",""), entry.get("due_amount",""), entry.get("cost_basis",""),
-                    entry.get("profit",""), entry.get("profit_percentage","")
-                ))
+                self.rows[index] = history_row(entry)
+                self.tree.item(selected_item, values=self.rows[index])
                 # تحديث السجل في بيانات الطرف (المورد/العميل)
                 person_name = entry.get("person")
                 if person_name and person_name in self.parent.data["parties"]:
@@ -1788,8 +2390,7 @@ class HistoryWindow:
                             })
                             break
                 # حفظ التغييرات في الملف
-                save_data(self.parent.data)
-                make_backup(self.parent.data)
+                self.parent.persist(history=(index,), parties=(person_name,) if person_name else ())
                 messagebox.showinfo("تم", "تم تعديل السجل بنجاح.")
                 edit_window.destroy()
             except ValueError:
@@ -1835,7 +2436,7 @@ class ExpensesWindow:
         ttk.Button(tool_frame, text="⬇️ تصدير JSON", command=lambda: self.export_json(expenses)).pack(side=tk.LEFT, padx=4)
 
         # جدول المصروفات
-        cols = ("date","name","amount","description")
+        cols = EXPENSE_COLS
         headers_ar = {
             "date":"التاريخ",
             "name":"الاسم",
@@ -1857,9 +2458,7 @@ class ExpensesWindow:
 
         # ملء الجدول
         for i, e in enumerate(expenses):
-            self.tree.insert("", "end", iid=i, values=(
-                e.get("date"), e.get("name"), e.get("amount"), e.get("description", "")
-            ))
+            self.tree.insert("", "end", iid=i, values=expense_row(e))
 
         self.expenses = expenses
         self.parent = parent
@@ -1871,14 +2470,14 @@ class ExpensesWindow:
             expense = {
                 "date": now_iso(),
                 "name": name,
-                "amount": float(amount),
+                "amount": amount,
                 "description": description
             }
             self.expenses.append(expense)
-            self.tree.insert("", "end", values=(expense["date"], expense["name"], expense["amount"], expense["description"]))
+            # المعرّف هو موضع المصروف في القائمة كما في بقية الصفوف (يعتمد عليه الحذف)
+            self.tree.insert("", "end", iid=len(self.expenses) - 1, values=expense_row(expense))
             # حفظ التغييرات في الملف
-            save_data(self.parent.data)
-            make_backup(self.parent.data)
+            self.parent.persist(expenses=True)
             # --- FIX: Refresh the main window's table to update profit ---
             self.parent.refresh_table()
             # -----------------------------------------------------------
@@ -1895,12 +2494,9 @@ class ExpensesWindow:
         for item in self.tree.get_children():
             self.tree.delete(item)
         for i, e in enumerate(self.expenses):
-            self.tree.insert("", "end", iid=i, values=(
-                e.get("date"), e.get("name"), e.get("amount"), e.get("description", "")
-            ))
+            self.tree.insert("", "end", iid=i, values=expense_row(e))
         # حفظ التغييرات في الملف
-        save_data(self.parent.data)
-        make_backup(self.parent.data)
+        self.parent.persist(expenses=True)
         # --- FIX: Refresh the main window's table to update profit ---
         self.parent.refresh_table()
         # -----------------------------------------------------------
@@ -1909,11 +2505,10 @@ class ExpensesWindow:
         if not path:
             return
         try:
-            with open(path, "w", encoding="utf-8", newline='') as f:
+            with open(path, "w", encoding="utf-8", newline='', buffering=EXPORT_BUFFER_SIZE) as f:
                 writer = csv.writer(f)
                 writer.writerow(["التاريخ","الاسم","القيمة","الوصف"])
-                for e in expenses:
-                    writer.writerow([e.get("date"), e.get("name"), e.get("amount"), e.get("description", "")])
+                writer.writerows(map(expense_row, expenses))
             messagebox.showinfo("تم", "تم تصدير المصروفات CSV.")
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل التصدير: {e}")
@@ -1922,8 +2517,8 @@ class ExpensesWindow:
         if not path:
             return
         try:
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(expenses, f, ensure_ascii=False, indent=2)
+            with open(path, "wb") as f:
+                f.write(json_dumps(expenses, pretty=True))
             messagebox.showinfo("تم", "تم تصدير المصروفات JSON.")
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل التصدير: {e}")
@@ -1970,9 +2565,8 @@ class AddExpenseDialog:
         if not name or not amount:
             messagebox.showerror("خطأ", "يرجى إدخال الاسم والقيمة.")
             return
-        try:
-            float(amount)
-        except:
+        amount = parse_number(amount)
+        if amount is None:
             messagebox.showerror("خطأ", "قيمة رقمية غير صحيحة.")
             return
         self.result = (name, amount, desc)
@@ -2081,20 +2675,9 @@ class PartiesWindow:
         ttk.Label(frm, text=f"الرصيد: {party_info.get('balance', 0.0)} جنيه").grid(row=2, column=0, sticky="w")
         ttk.Label(frm, text=f"عدد المعاملات: {len(party_info.get('transactions', []))}").grid(row=3, column=0, sticky="w")
 
-        cols = ("date","operation","metal","quantity","total_price","paid_amount","due_amount","profit")
-        headers_ar = {
-            "date":"التاريخ",
-            "operation":"العملية",
-            "metal":"المعدن",
-            "quantity":"الكمية",
-            "total_price":"القيمة الإجمالية",
-            "paid_amount":"المبلغ المدفوع",
-            "due_amount":"المبلغ المتبقي",
-            "profit":"الربح"
-        }
-        tree = ttk.Treeview(frm, columns=cols, show="headings", height=10)
-        for c in cols:
-            tree.heading(c, text=headers_ar.get(c,c))
+        tree = ttk.Treeview(frm, columns=PARTY_TX_COLS, show="headings", height=10)
+        for c in PARTY_TX_COLS:
+            tree.heading(c, text=HISTORY_HEADERS_AR[c])
             tree.column(c, anchor="center", width=100)
         tree.grid(row=4, column=0, columnspan=3, pady=8, sticky="nsew")
 
@@ -2124,19 +2707,20 @@ class PartiesWindow:
             }
             party_type_ar = "مورد" if is_supplier else "عميل"
             self.tree.insert("", "end", iid=name.strip(), values=(name.strip(), party_type_ar, 0.0, 0))
-            save_data(self.parent.data)
-            make_backup(self.parent.data)
+            self.parent.persist(parties=(name.strip(),))
     def export_csv(self, parties):
         path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv")])
         if not path:
             return
         try:
-            with open(path, "w", encoding="utf-8", newline='') as f:
+            with open(path, "w", encoding="utf-8", newline='', buffering=EXPORT_BUFFER_SIZE) as f:
                 writer = csv.writer(f)
                 writer.writerow(["الاسم","النوع","الرصيد","عدد المعاملات"])
-                for name, info in parties.items():
-                    party_type = "مورد" if info.get("type") == "supplier" else "عميل"
-                    writer.writerow([name, party_type, info.get("balance", 0.0), len(info.get("transactions", []))])
+                writer.writerows(
+                    (name, "مورد" if info.get("type") == "supplier" else "عميل",
+                     info.get("balance", 0.0), len(info.get("transactions", [])))
+                    for name, info in parties.items()
+                )
             messagebox.showinfo("تم", "تم تصدير الحسابات CSV.")
         except Exception as e:
             messagebox.showerror("خطأ", f"فشل التصدير: {e}")